@@ -1,23 +1,173 @@
-from flask import Flask, request, jsonify, abort
+from flask import Flask, Blueprint, request, jsonify, abort
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import delete, insert, update
 from sqlalchemy.exc import SQLAlchemyError
-import json
+import gzip
+import hashlib
+import itertools
+import logging
+import threading
+import orjson
 from flask_cors import CORS
+from flask_compress import Compress
 
-from .database.models import db_drop_and_create_all, setup_db, Drink  # noqa
+from .database.models import db_drop_and_create_all, setup_db, db, Drink, drink_columns, drinks_long_json  # noqa
 from .auth.auth import AuthError, requires_auth
 
+
+class ORJSONProvider(DefaultJSONProvider):
+    '''
+    ORJSONProvider
+        serializes responses and parses json with orjson instead of stdlib json
+        formatting options (indent, sort_keys...) flask passes in are ignored
+    '''
+    def dumps(self, obj, **_kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s, **_kwargs):
+        return orjson.loads(s)
+
+
+'''
+get_request_json()
+    parses the request body with orjson, without keeping a copy on the request
+    returns None if the body is empty or not valid json
+    aborts with 413 if the body is larger than MAX_CONTENT_LENGTH
+'''
+def get_request_json():
+    raw = read_request_body(request.max_content_length)
+    if not raw:
+        return None
+    try:
+        return orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        return None
+
+
+'''
+read_request_body(limit)
+    reads at most limit bytes of the request body, aborts with 413 past that
+    get_data() does not enforce MAX_CONTENT_LENGTH, and a chunked body has no
+    Content-Length to check up front, so the limit is applied while reading
+'''
+def read_request_body(limit):
+    if (request.content_length or 0) > limit:
+        abort(413)
+    chunks = []
+    size = 0
+    while True:
+        chunk = request.stream.read(limit + 1 - size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size += len(chunk)
+        if size > limit:
+            abort(413)
+    return b''.join(chunks)
+
+
+'''
+valid_recipe(recipe)
+    checks recipe against [{'color': string, 'name': string, 'parts': number}]
+'''
+def valid_recipe(recipe):
+    return isinstance(recipe, list) and all(
+        isinstance(r, dict)
+        and isinstance(r.get('color'), str)
+        and isinstance(r.get('name'), str)
+        # bool is a subclass of int, but true is not a number of parts
+        and isinstance(r.get('parts'), (int, float))
+        and not isinstance(r.get('parts'), bool)
+        for r in recipe
+    )
+
+
+'''
+drink_fields(data, partial=False)
+    validates the title and recipe of a drink request body
+    partial allows either field to be missing, for updates
+    returns a dict of the fields present, or None if data is invalid
+'''
+def drink_fields(data, partial=False):
+    if not isinstance(data, dict):
+        return None
+    fields = {}
+
+    if 'title' in data:
+        if not isinstance(data['title'], str) or data['title'].strip() == '':
+            return None
+        fields['title'] = data['title']
+    elif not partial:
+        return None
+
+    if 'recipe' in data:
+        if not valid_recipe(data['recipe']):
+            return None
+        fields['recipe'] = data['recipe']
+    elif not partial:
+        return None
+
+    return fields
+
+
+log = logging.getLogger(__name__)
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
+# request bodies above this size are rejected with 413, see read_request_body
+app.config['MAX_CONTENT_LENGTH'] = 64 * 1024
+# gzip json bodies of 1 KiB or more, level 4 trades a little ratio for speed
+app.config['COMPRESS_ALGORITHM'] = 'gzip'
+app.config['COMPRESS_MIMETYPES'] = ['application/json']
+app.config['COMPRESS_LEVEL'] = 4
+app.config['COMPRESS_MIN_SIZE'] = 1024
 setup_db(app)
 CORS(app)
+Compress(app)
 
 '''
-DONE uncomment the following line to initialize the datbase
+flask init-db
+    initializes the database, run it once before the first `flask run`
 !! NOTE THIS WILL DROP ALL RECORDS AND START YOUR DB FROM SCRATCH
-!! NOTE THIS MUST BE UNCOMMENTED ON FIRST RUN
 '''
-db_drop_and_create_all()
+@app.cli.command('init-db')
+def init_db():
+    db_drop_and_create_all()
+
+## Drinks Cache
+'''
+drinks_cache
+    (version, etag, body, gzipped) of the serialized GET /drinks response
+    gzipped is body compressed once up front, or None below COMPRESS_MIN_SIZE
+    it is kept per process, body is None until the first request after a write
+    every endpoint that writes drinks must call invalidate_drinks_cache()
+'''
+drinks_versions = itertools.count()
+drinks_cache = (next(drinks_versions), None, None, None)
+drinks_cache_lock = threading.Lock()
+
+
+def invalidate_drinks_cache():
+    global drinks_cache
+    with drinks_cache_lock:
+        drinks_cache = (next(drinks_versions), None, None, None)
+
+
+def store_drinks_cache(version, etag, body, gzipped):
+    global drinks_cache
+    with drinks_cache_lock:
+        # a write since the body was built makes it stale
+        if drinks_cache[0] == version:
+            drinks_cache = (version, etag, body, gzipped)
+
 
 ## ROUTES
+'''
+bp
+    blueprint holding every drink endpoint, registered on app below them
+'''
+bp = Blueprint('drinks', __name__)
+
 '''
 DONE implement endpoint
     GET /drinks
@@ -26,12 +176,37 @@ DONE implement endpoint
     returns status code 200 and json {"success": True, "drinks": drinks} where drinks is the list of drinks
         or appropriate status code indicating reason for failure
 '''
-@app.route('/drinks')
+@bp.route('/drinks')
 def get_drinks():
-    return {
-        'success': True,
-        'drinks': [d.short() for d in Drink.query.all()]
-    }
+    version, etag, body, gzipped = drinks_cache
+    if body is None:
+        body = orjson.dumps({
+            'success': True,
+            'drinks': [Drink.short(row) for row in db.session.execute(drink_columns)]
+        })
+        etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+        gzipped = None
+        if len(body) >= app.config['COMPRESS_MIN_SIZE']:
+            gzipped = gzip.compress(body, compresslevel=app.config['COMPRESS_LEVEL'])
+        store_drinks_cache(version, etag, body, gzipped)
+
+    # gzipped bodies carry the etag "<etag>:gzip", the same way flask-compress tags them
+    # weak comparison, so W/ tags sent back by intermediaries still match
+    matched = next((tag for tag in (etag, f'{etag}:gzip') if request.if_none_match.contains_weak(tag)), None)
+    if matched is None and gzipped is not None and request.accept_encodings['gzip'] > 0:
+        # the Content-Encoding header makes flask-compress leave this one alone
+        response = app.response_class(gzipped, mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+        response.set_etag(f'{etag}:gzip')
+    elif matched is None:
+        response = app.response_class(body, mimetype='application/json')
+        response.set_etag(etag)
+    else:
+        response = app.response_class(status=304)
+        response.set_etag(matched)
+    response.cache_control.public = True
+    response.cache_control.max_age = 0
+    return response
 
 
 '''
@@ -42,13 +217,14 @@ DONE implement endpoint
     returns status code 200 and json {"success": True, "drinks": drinks} where drinks is the list of drinks
         or appropriate status code indicating reason for failure
 '''
-@app.route('/drinks-detail')
+@bp.route('/drinks-detail')
 @requires_auth('get:drinks-detail')
 def get_drinks_detail(payload):
-    return {
-        'success': True,
-        'drinks': [d.long() for d in Drink.query.all()]
-    }
+    drinks = db.session.execute(drinks_long_json[db.engine.dialect.name]).scalar_one()
+    return app.response_class(
+        orjson.dumps({'success': True, 'drinks': orjson.Fragment(drinks)}),
+        mimetype='application/json'
+    )
 
 
 '''
@@ -59,23 +235,33 @@ DONE implement endpoint
         it should contain the drink.long() data representation
     returns status code 200 and json {"success": True, "drinks": drink} where drink an array containing only the newly created drink
         or appropriate status code indicating reason for failure
+    the body can also be a list of drinks, they are inserted in one transaction
+        and "drinks" contains all of them in the same order
 '''
-@app.route('/drinks', methods=['POST'])
+@bp.route('/drinks', methods=['POST'])
 @requires_auth('post:drinks')
 def create_drink(payload):
-    data = request.get_json() or abort(400)
-    title = data.get('title') or abort(400)
-    recipe = data.get('recipe') or abort(400)
-    recipe = json.dumps(recipe)
+    data = get_request_json()
+    items = data if isinstance(data, list) else [data]
+    rows = []
+    for item in items:
+        fields = drink_fields(item)
+        if fields is None:
+            abort(400)
+        rows.append({'title': fields['title'], 'recipe': orjson.dumps(fields['recipe']).decode()})
+    if not rows:
+        abort(400)
 
-    drink = Drink(title=title, recipe=recipe)
+    stmt = insert(Drink).returning(*drink_columns.selected_columns, sort_by_parameter_order=True)
     try:
-        drink.insert()
+        drinks = [Drink.long(row) for row in db.session.execute(stmt, rows)]
+        db.session.commit()
     except SQLAlchemyError:
         abort(422)
+    invalidate_drinks_cache()
     return {
         'success': True,
-        'drinks': [drink.long()]
+        'drinks': drinks
     }
 
 
@@ -90,24 +276,33 @@ DONE implement endpoint
     returns status code 200 and json {"success": True, "drinks": drink} where drink an array containing only the updated drink
         or appropriate status code indicating reason for failure
 '''
-@app.route('/drinks/<int:id>', methods=['PATCH'])
+@bp.route('/drinks/<int:id>', methods=['PATCH'])
 @requires_auth('patch:drinks')
 def patch_drink(_payload, id: int):
-    drink: Drink = Drink.query.get(id) or abort(404)
-    data = request.get_json()
+    fields = drink_fields(get_request_json(), partial=True)
+    if fields is None:
+        abort(400)
+    if 'recipe' in fields:
+        fields['recipe'] = orjson.dumps(fields['recipe']).decode()
 
-    if 'title' in data:
-        drink.title = data['title']
-    if 'recipe' in data:
-        drink.recipe = json.dumps(data['recipe'])
+    if fields:
+        stmt = (update(Drink).where(Drink.id == id).values(**fields)
+                .returning(*drink_columns.selected_columns)
+                .execution_options(synchronize_session=False))
+    else:
+        stmt = drink_columns.where(Drink.id == id)
     try:
-        drink.update()
+        row = db.session.execute(stmt).one_or_none()
+        db.session.commit()
     except SQLAlchemyError:
         abort(422)
+    if row is None:
+        abort(404)
+    invalidate_drinks_cache()
 
     return {
         'success': True,
-        'drinks': [drink.long()]
+        'drinks': [Drink.long(row)]
     }
 
 
@@ -121,60 +316,80 @@ DONE implement endpoint
     returns status code 200 and json {"success": True, "delete": id} where id is the id of the deleted record
         or appropriate status code indicating reason for failure
 '''
-@app.route('/drinks/<int:id>', methods=['DELETE'])
+@bp.route('/drinks/<int:id>', methods=['DELETE'])
 @requires_auth('delete:drinks')
 def delete_drink(_payload, id: int):
-    drink: Drink = Drink.query.get(id) or abort(404)
     try:
-        drink.delete()
+        result = db.session.execute(delete(Drink).where(Drink.id == id))
+        db.session.commit()
     except SQLAlchemyError:
         abort(422)
+    if result.rowcount == 0:
+        abort(404)
+    invalidate_drinks_cache()
     return {
         'success': True,
         'delete': id
     }
 
 
+# match /drinks/ as /drinks instead of answering with a redirect
+app.url_map.strict_slashes = False
+app.register_blueprint(bp)
+
 
 ## Error Handling
 '''
 DONE implement error handler for 404
     error handler should conform to general task above 
 '''
+'''
+error_bodies
+    the error payloads never change, so they are serialized once at import
+'''
+error_bodies = {
+    code: orjson.dumps({
+        'success': False,
+        'error': code,
+        'message': message
+    })
+    for code, message in [
+        (400, 'bad request'),
+        (403, 'forbidden'),
+        (404, 'resource not found'),
+        (413, 'request entity too large'),
+        (422, 'unprocessable'),
+    ]
+}
+
+
+def error_response(code):
+    return app.response_class(error_bodies[code], status=code, mimetype='application/json')
+
+
 @app.errorhandler(404)
 def not_found(_e):
-    return {
-        'success': False,
-        'error': 404,
-        'message': 'resource not found'
-    }, 404
+    return error_response(404)
 
 
 @app.errorhandler(400)
 def bad_request(_e):
-    return {
-        'success': False,
-        'error': 400,
-        'message': 'bad request'
-    }, 400
+    return error_response(400)
 
 
 @app.errorhandler(403)
 def forbidden(_e):
-    return {
-        'success': False,
-        'error': 403,
-        'message': 'forbidden'
-    }, 403
+    return error_response(403)
+
+
+@app.errorhandler(413)
+def too_large(_e):
+    return error_response(413)
 
 
 @app.errorhandler(422)
 def unprocessable(_e):
-    return {
-        'success': False,
-        'error': 422,
-        'message': 'unprocessable'
-    }, 422
+    return error_response(422)
 
 
 '''
@@ -182,9 +397,9 @@ DONE implement error handler for AuthError
     error handler should conform to general task above 
 '''
 @app.errorhandler(AuthError)
-def not_found(e: AuthError):
-    from sys import exc_info
-    print(exc_info())
+def auth_error(e: AuthError):
+    if app.debug:
+        log.exception('auth error')
     return {
         'success': False,
         'error': e.status_code,
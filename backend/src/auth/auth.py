@@ -1,5 +1,8 @@
+import hashlib
 import json
-from flask import request, _request_ctx_stack, abort
+import threading
+import time
+from flask import request, abort
 from functools import wraps
 from jose import jwt
 from urllib.request import urlopen
@@ -8,6 +11,14 @@ from urllib.request import urlopen
 AUTH0_DOMAIN = 'drdilyor.us.auth0.com'
 ALGORITHMS = ['RS256']
 API_AUDIENCE = 'coffee-shop'
+# seconds a request thread may block waiting for Auth0 to serve the jwks
+JWKS_TIMEOUT = 5
+# seconds the fetched jwks is reused before it is downloaded again
+JWKS_TTL = 3600
+# seconds that must pass before an unknown key id can trigger another download
+JWKS_MIN_REFRESH = 60
+# number of verified tokens remembered by verify_decode_jwt
+TOKEN_CACHE_SIZE = 1024
 
 ## AuthError Exception
 '''
@@ -82,6 +93,64 @@ def check_permissions(permission, payload):
     
     return True
 
+'''
+get_jwks(refresh=False)
+    returns the Auth0 /.well-known/jwks.json document
+    it is downloaded at most once every JWKS_TTL seconds
+    refresh forces a download, but at most once every JWKS_MIN_REFRESH seconds
+'''
+jwks_cache = {'jwks': None, 'fetched_at': 0.0}
+
+
+def get_jwks(refresh=False):
+    age = time.monotonic() - jwks_cache['fetched_at']
+    if (jwks_cache['jwks'] is None or age > JWKS_TTL
+            or (refresh and age > JWKS_MIN_REFRESH)):
+        try:
+            jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json', timeout=JWKS_TIMEOUT)
+            jwks = json.loads(jsonurl.read())
+        except OSError:
+            raise AuthError({
+                'code': 'jwks_unavailable',
+                'description': 'Unable to fetch the signing keys.'
+            }, 503)
+        jwks_cache['jwks'] = jwks
+        jwks_cache['fetched_at'] = time.monotonic()
+    return jwks_cache['jwks']
+
+
+'''
+token_cache
+    maps a blake2b digest of a verified token to (payload, exp)
+    a hit only needs to check that the token has not expired since
+    the oldest entry is dropped once TOKEN_CACHE_SIZE is reached
+'''
+token_cache = {}
+token_cache_lock = threading.Lock()
+
+
+def get_cached_payload(digest):
+    with token_cache_lock:
+        entry = token_cache.get(digest)
+        if entry is None:
+            return None
+        payload, exp = entry
+        if exp <= time.time():
+            del token_cache[digest]
+            return None
+        return payload
+
+
+def cache_payload(digest, payload):
+    exp = payload.get('exp')
+    if exp is None:
+        return
+    with token_cache_lock:
+        if len(token_cache) >= TOKEN_CACHE_SIZE:
+            del token_cache[next(iter(token_cache))]
+        token_cache[digest] = (payload, exp)
+
+
 '''
 DONE implement verify_decode_jwt(token) method
     @INPUTS
@@ -96,8 +165,11 @@ DONE implement verify_decode_jwt(token) method
     !!NOTE urlopen has a common certificate error described here: https://stackoverflow.com/questions/50236117/scraping-ssl-certificate-verify-failed-error-for-http-en-wikipedia-org
 '''
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+    digest = hashlib.blake2b(token.encode(), digest_size=32).digest()
+    payload = get_cached_payload(digest)
+    if payload is not None:
+        return payload
+
     unverified_header = jwt.get_unverified_header(token)
     rsa_key = {}
     if 'kid' not in unverified_header:
@@ -106,6 +178,11 @@ def verify_decode_jwt(token):
             'description': 'Authorization malformed.'
         }, 401)
 
+    jwks = get_jwks()
+    if not any(key['kid'] == unverified_header['kid'] for key in jwks['keys']):
+        # the signing keys may have been rotated since they were cached
+        jwks = get_jwks(refresh=True)
+
     for key in jwks['keys']:
         if key['kid'] == unverified_header['kid']:
             rsa_key = {
@@ -125,6 +202,7 @@ def verify_decode_jwt(token):
                 issuer='https://' + AUTH0_DOMAIN + '/'
             )
 
+            cache_payload(digest, payload)
             return payload
 
         except jwt.ExpiredSignatureError:
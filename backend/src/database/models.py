@@ -1,12 +1,31 @@
 import os
-from sqlalchemy import Column, String, Integer
+from sqlalchemy import Column, String, Integer, select, text
 from flask_sqlalchemy import SQLAlchemy
 import json
+import orjson
 
 database_filename = "database.db"
 project_dir = os.path.dirname(os.path.abspath(__file__))
 database_path = "sqlite:///{}".format(os.path.join(project_dir, database_filename))
 
+'''
+engine_options
+    connection pool settings passed to create_engine
+    size pool_size to the number of threads serving requests (pool_size ≈ worker_threads)
+    so a request never waits on a connection, max_overflow absorbs bursts above that
+    set DATABASE_PRE_PING=1 when the database sits behind a network that drops idle
+    connections, the ping costs an extra round-trip on every checkout
+    query_cache_size bounds the compiled sql cache, raised from the default 500 so
+    every statement the app issues stays compiled
+'''
+engine_options = {
+    'pool_size': 20,
+    'max_overflow': 10,
+    'pool_recycle': 1800,
+    'pool_pre_ping': os.environ.get('DATABASE_PRE_PING') == '1',
+    'query_cache_size': 1200,
+}
+
 db = SQLAlchemy()
 
 '''
@@ -16,7 +35,7 @@ setup_db(app)
 def setup_db(app):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-    db.app = app
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options
     db.init_app(app)
 
 '''
@@ -45,10 +64,11 @@ class Drink(db.Model):
     '''
     short()
         short form representation of the Drink model
+        can also be called as Drink.short(row) on a row of the id, title
+        and recipe columns, see drink_columns
     '''
     def short(self):
-        print(json.loads(self.recipe))
-        short_recipe = [{'color': r['color'], 'parts': r['parts']} for r in json.loads(self.recipe)]
+        short_recipe = [{'color': r['color'], 'parts': r['parts']} for r in orjson.loads(self.recipe)]
         return {
             'id': self.id,
             'title': self.title,
@@ -58,12 +78,14 @@ class Drink(db.Model):
     '''
     long()
         long form representation of the Drink model
+        can also be called as Drink.long(row), like short()
+        the recipe is handed to orjson as-is, it is never parsed
     '''
     def long(self):
         return {
             'id': self.id,
             'title': self.title,
-            'recipe': json.loads(self.recipe)
+            'recipe': orjson.Fragment(self.recipe)
         }
 
     '''
@@ -104,4 +126,33 @@ class Drink(db.Model):
         db.session.commit()
 
     def __repr__(self):
-        return json.dumps(self.short())
\ No newline at end of file
+        return json.dumps(self.short())
+
+
+'''
+drink_columns
+    selects only the columns short() and long() read, as plain rows
+    avoids building and tracking a Drink instance for every row
+    EXAMPLE
+        drinks = [Drink.short(row) for row in db.session.execute(drink_columns)]
+'''
+drink_columns = select(Drink.id, Drink.title, Drink.recipe)
+
+
+'''
+drinks_long_json
+    builds the json array of every drink's long() inside the database, as text
+    keyed by dialect name, only postgresql and sqlite are supported
+'''
+drinks_long_json = {
+    'postgresql': text(
+        "SELECT coalesce(json_agg(json_build_object("
+        "'id', id, 'title', title, 'recipe', recipe::json)), '[]'::json)::text "
+        f"FROM {Drink.__tablename__}"
+    ),
+    'sqlite': text(
+        "SELECT json_group_array(json_object("
+        "'id', id, 'title', title, 'recipe', json(recipe))) "
+        f"FROM {Drink.__tablename__}"
+    ),
+}